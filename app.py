@@ -1,44 +1,624 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
 import face_recognition
+import dlib
 import numpy as np
-import base64
+import binascii
 import io
 from PIL import Image
+import cv2
+import faiss
+import numba
+import msgspec
 import pickle
+import struct
 import os
+import threading
+import atexit
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: no gunicorn workers, so a single process owns the storage files
+    fcntl = None
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson, which is much faster and also serializes numpy values"""
+
+    option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Build jsonify() responses from orjson's bytes without a str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
-# Storage file for face encodings and metadata
-STORAGE_FILE = 'face_data.pkl'
+# Append-only storage files: face metadata (length-prefixed msgpack frames),
+# face encodings (raw float32 rows) and a bitmap of live (not deleted) rows,
+# plus the person IDs of the rows kept by the last compaction (int64, followed
+# by the ID of the next row) and the (large database only) IVF-PQ index
+METADATA_FILE = 'meta.mpk'
+EMBEDDINGS_FILE = 'faces.f32'
+ALIVE_FILE = 'alive.bits'
+IDS_FILE = 'ids.i64'
+INDEX_FILE = 'face.index'
+
+# Change counters of the storage files (int64 rewrite generation and deletion
+# count), compared by every process to notice the others' rewrites and deletions
+GENERATION_FILE = 'face.gen'
+
+# Lock file serializing storage writes across worker processes
+LOCK_FILE = 'face.lock'
+
+# Pickle database written by older versions; migrated on first load
+LEGACY_STORAGE_FILE = 'face_data.pkl'
+
+msgpack_encoder = msgspec.msgpack.Encoder()
+
+# Uploads starting with these bytes are decoded by OpenCV (libjpeg-turbo), others by PIL
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# face_recognition encodings are 128-d vectors, stored as 512-byte float32 records
+EMBEDDING_DIM = 128
+RECORD_SIZE = EMBEDDING_DIM * 4
+
+# Face detector: dlib's CNN detector when dlib was built with CUDA, otherwise HOG
+# (the CNN detector is far too slow on CPU). The CNN runs without upsampling
+DETECTION_MODEL = 'cnn' if dlib.DLIB_USE_CUDA else 'hog'
+DETECTION_UPSAMPLE = 0 if DETECTION_MODEL == 'cnn' else 1
+
+# Images are downscaled so their longest side is at most this many pixels
+# before face detection; encodings are still computed on the full image
+DETECTION_MAX_SIZE = 640
+
+# Landmark model used to align faces before encoding: dlib's 5-point 'small'
+# model is faster than the 68-point 'large' one and encodes equivalently
+LANDMARK_MODEL = 'small'
+
+# Recognition tolerance on the face_recognition (L2) distance (lower = stricter):
+# a face matches its nearest registered face if they are at most this far apart.
+# Encodings are kept raw: dlib's are not unit length (norms around 1.4), so
+# cosine similarity of normalized encodings would not be equivalent to this rule
+TOLERANCE = 0.6
+
+# Databases larger than this are searched with an approximate IVF-PQ index
+# (nlist ~ sqrt(N) clusters, IVF_NPROBE of them probed per query) instead of a flat scan.
+# Each encoding is product-quantized to PQ_M codes of PQ_NBITS bits (8 bytes instead
+# of 512), and the best RERANK_CANDIDATES hits are re-ranked with exact distances
+IVF_THRESHOLD = 5000
+IVF_NPROBE = 16
+PQ_M = 8
+PQ_NBITS = 8
+RERANK_CANDIDATES = 10
+
+# Deleted people are tombstoned; the storage is compacted once more than this
+# fraction of its rows are tombstones
+COMPACT_THRESHOLD = 0.25
+
+# Starting distance of the nearest() search: fastmath lets LLVM assume there are
+# no infinities, so the kernel can't start from np.inf
+NO_DISTANCE = np.finfo(np.float32).max
+
+@numba.njit(parallel=True, fastmath=True, boundscheck=False)
+def nearest(embeddings, alive, queries):
+    """
+    Return (rows, L2 distances) of the closest live row to each query.
+    Streams the encodings once, keeping a per-thread best instead of
+    materializing the full distance matrix.
+    """
+    n_threads = numba.get_num_threads()
+    n_queries = queries.shape[0]
+    # Row -1 means no live row was seen
+    best = np.full((n_threads, n_queries), NO_DISTANCE, dtype=np.float32)
+    best_rows = np.full((n_threads, n_queries), -1, dtype=np.int64)
+    for i in numba.prange(embeddings.shape[0]):
+        if alive[i]:
+            thread = numba.get_thread_id()
+            for q in range(n_queries):
+                distance = np.float32(0.0)
+                for k in range(embeddings.shape[1]):
+                    difference = embeddings[i, k] - queries[q, k]
+                    distance += difference * difference
+                if distance < best[thread, q]:
+                    best[thread, q] = distance
+                    best_rows[thread, q] = i
+    
+    rows = np.empty(n_queries, dtype=np.int64)
+    distances = np.empty(n_queries, dtype=np.float32)
+    for q in range(n_queries):
+        thread = best[:, q].argmin()
+        rows[q] = best_rows[thread, q]
+        distances[q] = np.sqrt(best[thread, q])
+    return rows, distances
+
+def index_ids(index):
+    """Return the person IDs stored in an IVF-PQ index"""
+    invlists = index.invlists
+    # Empty lists are skipped: rev_swig_ptr returns a float32 array for them
+    ids = [
+        faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+        for i in range(index.nlist) if invlists.list_size(i)
+    ]
+    return np.concatenate(ids).astype('int64') if ids else np.empty(0, dtype='int64')
+
+def read_generation():
+    """Return the (rewrite generation, deletion count) of the storage files"""
+    if not os.path.exists(GENERATION_FILE):
+        return 0, 0
+    rewrites, deletions = np.fromfile(GENERATION_FILE, dtype=np.int64)
+    return int(rewrites), int(deletions)
+
+def read_frames(offset, limit):
+    """Read up to limit complete metadata frames from offset; return (metadata, end offset)"""
+    metadata = []
+    if not os.path.exists(METADATA_FILE):
+        return metadata, offset
+    with open(METADATA_FILE, 'rb') as f:
+        f.seek(offset)
+        buf = f.read()
+    
+    # Stop at a frame that is still being (or was never fully) written
+    position = 0
+    while len(metadata) < limit and position + 4 <= len(buf):
+        start = position + 4
+        end = start + struct.unpack_from('>I', buf, position)[0]
+        if end > len(buf):
+            break
+        metadata.append(msgspec.msgpack.decode(buf[start:end]))
+        position = end
+    return metadata, offset + position
+
+def read_alive(n):
+    """Read the alive flags of the first n rows from the bitmap"""
+    alive = np.ones(n, dtype=bool)
+    if os.path.exists(ALIVE_FILE):
+        bits = np.unpackbits(np.fromfile(ALIVE_FILE, dtype=np.uint8))[:n].astype(bool)
+        alive[:len(bits)] = bits
+    return alive
+
+def read_ids(n):
+    """Return the person IDs of the first n rows and the next person ID"""
+    # Rows appended since the last compaction get consecutive IDs
+    recorded = np.fromfile(IDS_FILE, dtype=np.int64) if os.path.exists(IDS_FILE) else np.zeros(1, dtype=np.int64)
+    kept, next_id = len(recorded) - 1, int(recorded[-1])
+    return np.append(recorded[:kept], next_id + np.arange(n - kept)), next_id + n - kept
+
+def stored_rows():
+    """Number of complete encoding records in the encodings file"""
+    return os.path.getsize(EMBEDDINGS_FILE) // RECORD_SIZE if os.path.exists(EMBEDDINGS_FILE) else 0
+
+def map_embeddings(n):
+    """Memory-map the first n encoding records read-only; worker processes share the pages"""
+    if n == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.memmap(EMBEDDINGS_FILE, dtype=np.float32, mode='r', shape=(n, EMBEDDING_DIM))
+
+def replace_file(path, write):
+    """Write a file through a temporary file renamed into place, so readers and memmaps never see it half-written"""
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+@contextmanager
+def storage_lock():
+    """Hold the exclusive storage file lock through a separate open file"""
+    # flock() locks belong to the open file, so this also excludes other
+    # threads of this process that lock through their own handle
+    with open(LOCK_FILE, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def write_index(index):
+    """Write the FAISS index file through a uniquely named temporary file renamed into place (file lock held)"""
+    fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(INDEX_FILE)), suffix='.tmp')
+    os.close(fd)
+    faiss.write_index(index, path)
+    os.replace(path, INDEX_FILE)
+
+def save_index(index, generation):
+    """Write a rebuilt index from the background writer, unless the storage was rewritten since it was built"""
+    with storage_lock():
+        if read_generation()[0] == generation:
+            write_index(index)
+
+class FaceDB:
+    """
+    Registered faces: encodings in a float32 (N, 128) array memory-mapped from
+    the encodings file, plus a metadata list. Row i belongs to person ids[i]
+    (ascending). Deleted people keep their row with a None metadata tombstone
+    until compact() drops them; person IDs never change and are never reused.
+    
+    Registrations are appended to the storage files and deletions only rewrite
+    the small alive bitmap, so neither has to rewrite the whole database until
+    tombstones pass COMPACT_THRESHOLD.
+    Several worker processes can share the files: mutations hold an exclusive
+    file lock, and every process tails the logs (sync) to pick up the others'
+    changes. Since the encodings are a read-only mapping of that file rather
+    than a private copy, workers share one copy through the OS page cache.
+    Rebuilt indexes are written by a background writer thread, which takes
+    the file lock itself and drops writes made stale by a rewrite.
+    """
+
+    def __init__(self, embeddings=None, metadata=None, ids=None, next_id=0, index=None, metadata_size=0):
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        
+        # Lock and append handles, opened on first use
+        self.lock_file = None
+        self.embeddings_log = None
+        self.metadata_log = None
+        
+        self.reset(embeddings, metadata, ids, next_id, index, metadata_size)
+
+    def reset(self, embeddings=None, metadata=None, ids=None, next_id=0, index=None, metadata_size=0):
+        """Replace the in-memory contents; metadata_size is how much of the metadata log they cover"""
+        self.metadata = metadata if metadata is not None else []
+        self.n = len(self.metadata)
+        if ids is None:
+            ids, next_id = np.arange(self.n, dtype=np.int64), self.n
+        self.ids = ids
+        self.next_id = next_id
+        
+        # Normally a memmap of the encodings file; save() remaps in-memory encodings
+        self.embeddings = embeddings if embeddings is not None else map_embeddings(0)
+        self.alive = np.array([m is not None for m in self.metadata], dtype=bool)
+        
+        # Storage file versions this view reflects, checked by sync()
+        self.metadata_size = metadata_size
+        self.generation = read_generation()
+        
+        self.index = index
+        if self.index is not None:
+            # The index file is only rewritten when the index is rebuilt, so
+            # catch up with registrations and deletions logged since then
+            ids = index_ids(self.index)
+            live_ids = self.ids[self.alive[:self.n]]
+            self.index.remove_ids(np.setdiff1d(ids, live_ids))
+            missing = np.setdiff1d(live_ids, ids)
+            self.index.add_with_ids(np.ascontiguousarray(self.embeddings[np.searchsorted(self.ids, missing)]), missing)
+        if len(self) > IVF_THRESHOLD and (self.index is None or self.needs_retrain()):
+            self.build_index()
+
+    @staticmethod
+    def read_storage():
+        """Read the complete records of the storage files as (embeddings, metadata, ids, next_id, metadata_size)"""
+        metadata, metadata_size = read_frames(0, stored_rows())
+        n = len(metadata)
+        ids, next_id = read_ids(n)
+        if n == 0:
+            return None, metadata, ids, next_id, metadata_size
+        
+        embeddings = map_embeddings(n)
+        for row in np.flatnonzero(~read_alive(n)):
+            metadata[row] = None
+        return embeddings, metadata, ids, next_id, metadata_size
+
+    @classmethod
+    def load(cls):
+        """Load stored face metadata, encodings and index"""
+        with storage_lock():
+            if not os.path.exists(METADATA_FILE) and os.path.exists(LEGACY_STORAGE_FILE):
+                with open(LEGACY_STORAGE_FILE, 'rb') as f:
+                    data = pickle.load(f)
+                db = cls(np.asarray(data['encodings'], dtype=np.float32).reshape(-1, EMBEDDING_DIM), data['metadata'])
+                db.save()
+                return db
+            
+            embeddings, metadata, ids, next_id, metadata_size = cls.read_storage()
+            index = faiss.read_index(INDEX_FILE) if os.path.exists(INDEX_FILE) else None
+            db = cls(embeddings, metadata, ids, next_id, index, metadata_size)
+            db.truncate_torn_tail()
+            return db
+
+    def save(self):
+        """Rewrite all storage files from memory (file lock held)"""
+        self.close()
+        
+        def write_metadata(f):
+            for metadata in self.metadata:
+                frame = msgpack_encoder.encode(metadata)
+                f.write(struct.pack('>I', len(frame)) + frame)
+        
+        replace_file(EMBEDDINGS_FILE, self.embeddings[:self.n].tofile)
+        self.embeddings = map_embeddings(self.n)
+        replace_file(ALIVE_FILE, self.pack_alive().tofile)
+        replace_file(IDS_FILE, np.append(self.ids[:self.n], self.next_id).tofile)
+        replace_file(METADATA_FILE, write_metadata)
+        # Other processes reload once they see the new rewrite generation
+        self.generation = (read_generation()[0] + 1, 0)
+        replace_file(GENERATION_FILE, np.array(self.generation, dtype=np.int64).tofile)
+        
+        if self.index is not None:
+            write_index(self.index)
+        elif os.path.exists(INDEX_FILE):
+            os.remove(INDEX_FILE)
+        
+        self.metadata_size = os.path.getsize(METADATA_FILE)
+
+    def pack_alive(self):
+        """Pack the alive flags into a bitmap (N / 8 bytes)"""
+        # Pad the last byte with live bits: rows appended later read as alive
+        bits = np.ones(-(-self.n // 8) * 8, dtype=bool)
+        bits[:self.n] = self.alive[:self.n]
+        return np.packbits(bits)
+
+    @contextmanager
+    def file_lock(self, shared=False):
+        """Hold the lock that serializes storage writes across worker processes (shared: for reading)"""
+        if fcntl is None:
+            yield
+            return
+        if self.lock_file is None:
+            self.lock_file = open(LOCK_FILE, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def truncate_torn_tail(self):
+        """Drop a record half-written by a crashed process so later appends line up (file lock held)"""
+        for path, size in ((EMBEDDINGS_FILE, self.n * RECORD_SIZE), (METADATA_FILE, self.metadata_size)):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def close(self):
+        """Close the append handles"""
+        if self.embeddings_log is not None:
+            self.embeddings_log.close()
+            self.metadata_log.close()
+            self.embeddings_log = self.metadata_log = None
+
+    def after_fork(self):
+        """Give a forked worker its own lock, writer thread and file handles"""
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        # flock() locks belong to the open file, which the parent's handle shares
+        self.lock_file = None
+        self.embeddings_log = self.metadata_log = None
+
+    def shutdown(self):
+        """Finish pending writes and close the append handles"""
+        self.writer.shutdown(wait=True)
+        self.close()
+
+    def build_index(self):
+        """Train, fill and save an IVF-PQ index over the live encodings, keyed by person ID"""
+        rows = np.flatnonzero(self.alive[:self.n])
+        encodings = self.embeddings[rows]
+        quantizer = faiss.IndexFlatL2(EMBEDDING_DIM)
+        self.index = faiss.IndexIVFPQ(quantizer, EMBEDDING_DIM, int(np.sqrt(len(rows))), PQ_M, PQ_NBITS, faiss.METRIC_L2)
+        self.index.train(encodings)
+        self.index.nprobe = IVF_NPROBE
+        
+        # IVF-PQ stores the person IDs in its inverted lists, so they stay stable across deletions
+        self.index.add_with_ids(encodings, self.ids[rows])
+        self.writer.submit(save_index, faiss.clone_index(self.index), self.generation[0])
+
+    def needs_retrain(self):
+        """Whether the database has grown 4x since the index was trained (nlist ~ sqrt(N) would double)"""
+        return np.sqrt(len(self)) >= 2 * self.index.nlist
+
+    def index_rows(self, start):
+        """Add the live rows from start onwards to the index, building or retraining it when due"""
+        # New encodings are coded with the existing quantizers until the next retrain
+        if self.index is not None and not self.needs_retrain():
+            rows = np.flatnonzero(self.alive[start:self.n]) + start
+            self.index.add_with_ids(np.ascontiguousarray(self.embeddings[rows]), self.ids[rows])
+        elif len(self) > IVF_THRESHOLD:
+            self.build_index()
+
+    def __len__(self):
+        return int(self.alive[:self.n].sum())
+
+    def sync(self):
+        """Catch up with registrations, deletions and rewrites by other processes (lock held)"""
+        generation = read_generation()
+        if generation[0] != self.generation[0]:
+            # The database was rewritten (cleared or compacted) elsewhere: reload it
+            self.close()
+            embeddings, metadata, ids, next_id, metadata_size = self.read_storage()
+            index = faiss.read_index(INDEX_FILE) if os.path.exists(INDEX_FILE) else None
+            self.reset(embeddings, metadata, ids, next_id, index, metadata_size)
+            return
+        
+        # Encoding records are written before their metadata frame, so every
+        # complete frame has its record
+        start = self.n
+        metadata, self.metadata_size = read_frames(self.metadata_size, stored_rows() - start)
+        if metadata:
+            # Remap over the grown file rather than reading the new records into a private copy
+            self.embeddings = map_embeddings(start + len(metadata))
+            self.alive = np.append(self.alive, np.ones(len(metadata), dtype=bool))
+            self.ids = np.append(self.ids, self.next_id + np.arange(len(metadata)))
+            self.next_id += len(metadata)
+            self.metadata.extend(metadata)
+            self.n += len(metadata)
+        
+        if generation[1] != self.generation[1]:
+            self.generation = generation
+            for row in np.flatnonzero(self.alive[:self.n] & ~read_alive(self.n)):
+                self.metadata[row] = None
+                self.alive[row] = False
+                if self.index is not None and row < start:
+                    self.index.remove_ids(self.ids[row:row + 1])
+        
+        if self.n > start:
+            self.index_rows(start)
+
+    def refresh(self):
+        """Pick up changes made by other worker processes"""
+        # A shared file lock keeps a rewrite from being read half-way through
+        with self.lock, self.file_lock(shared=True):
+            self.sync()
+
+    def people(self):
+        """Return (person_id, metadata) of every registered person"""
+        # Taken under the lock: a concurrent compaction replaces ids and metadata
+        with self.lock:
+            return [(person_id, metadata) for person_id, metadata in zip(self.ids, self.metadata) if metadata is not None]
+
+    def row_of(self, person_id):
+        """Return the row of a registered person, or None if there is no such person"""
+        row = np.searchsorted(self.ids[:self.n], person_id)
+        if row < self.n and self.ids[row] == person_id and self.alive[row]:
+            return row
+        return None
+
+    def add(self, face_encoding, metadata):
+        """Store and log a face encoding with its metadata and return the new person_id"""
+        with self.lock, self.file_lock():
+            self.sync()
+            self.truncate_torn_tail()
+            
+            if self.embeddings_log is None:
+                self.embeddings_log = open(EMBEDDINGS_FILE, 'ab')
+                self.metadata_log = open(METADATA_FILE, 'ab')
+            frame = msgpack_encoder.encode(metadata)
+            self.embeddings_log.write(np.asarray(face_encoding, dtype=np.float32).tobytes())
+            self.embeddings_log.flush()
+            self.metadata_log.write(struct.pack('>I', len(frame)) + frame)
+            self.metadata_log.flush()
+            self.metadata_size += 4 + len(frame)
+            
+            # The new row is read back through a mapping that covers the record just written
+            person_id = self.next_id
+            self.embeddings = map_embeddings(self.n + 1)
+            self.alive = np.append(self.alive, True)
+            self.ids = np.append(self.ids, person_id)
+            self.next_id += 1
+            self.metadata.append(metadata)
+            self.n += 1
+            
+            self.index_rows(self.n - 1)
+        return person_id
+
+    def remove(self, person_id):
+        """Tombstone a person and return their metadata, or None if there is no such person"""
+        with self.lock, self.file_lock():
+            self.sync()
+            row = self.row_of(person_id)
+            if row is None:
+                return None
+            
+            metadata = self.metadata[row]
+            self.metadata[row] = None
+            self.alive[row] = False
+            if self.index is not None:
+                self.index.remove_ids(self.ids[row:row + 1])
+            
+            if self.n - len(self) > COMPACT_THRESHOLD * self.n:
+                self.compact()
+            else:
+                replace_file(ALIVE_FILE, self.pack_alive().tofile)
+                self.generation = (self.generation[0], self.generation[1] + 1)
+                replace_file(GENERATION_FILE, np.array(self.generation, dtype=np.int64).tofile)
+        return metadata
+
+    def compact(self):
+        """Drop the tombstoned rows from memory and storage, keeping person IDs (file lock held)"""
+        alive = self.alive[:self.n]
+        self.reset(
+            self.embeddings[alive], [m for m in self.metadata if m is not None],
+            self.ids[alive], self.next_id, self.index
+        )
+        self.save()
+
+    def clear(self):
+        """Delete every registered face"""
+        with self.lock, self.file_lock():
+            self.sync()
+            # Keep counting person IDs so they are never reused
+            self.reset(ids=np.empty(0, dtype=np.int64), next_id=self.next_id)
+            self.save()
+
+    def search(self, face_encodings):
+        """
+        Return a (person_id, metadata, L2 distance) match for each encoding: the
+        closest registered face, or (None, None, inf) if there is none
+        """
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        # Rows are resolved under the lock: a concurrent compaction shifts them
+        with self.lock:
+            if len(self) == 0:
+                return [(None, None, np.inf)] * len(queries)
+            
+            if self.index is not None:
+                _, ids = self.index.search(queries, RERANK_CANDIDATES)
+                # The index holds person IDs: look up their rows
+                candidates = np.searchsorted(self.ids[:self.n], ids)
+                
+                # PQ scores are approximate, so re-rank the candidates against the stored encodings
+                distances = np.linalg.norm(self.embeddings[candidates] - queries[:, None], axis=2)
+                distances[ids < 0] = np.inf
+                best = distances.argmin(1)
+                rows = np.arange(len(queries))
+                rows, distances = candidates[rows, best], distances[rows, best]
+            else:
+                rows, distances = nearest(np.asarray(self.embeddings[:self.n]), self.alive[:self.n], queries)
+            
+            return [(self.ids[row], self.metadata[row], distance) for row, distance in zip(rows, distances)]
 
-def load_data():
-    """Load stored face encodings and metadata"""
-    if os.path.exists(STORAGE_FILE):
-        with open(STORAGE_FILE, 'rb') as f:
-            return pickle.load(f)
-    return {'encodings': [], 'metadata': []}
+# Face database, loaded once per process and kept resident for every request.
+# It isn't loaded at import: gunicorn imports this module in its master process
+# before forking, and FAISS's OpenMP threads (libgomp) don't survive fork
+DB = None
+db_lock = threading.Lock()
 
-def save_data(data):
-    """Save face encodings and metadata"""
-    with open(STORAGE_FILE, 'wb') as f:
-        pickle.dump(data, f)
+def load_database():
+    """Load the face database into this process unless it is already loaded"""
+    global DB
+    with db_lock:
+        if DB is None:
+            db = FaceDB.load()
+            atexit.register(db.shutdown)
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=db.after_fork)
+            DB = db
+
+@app.before_request
+def ensure_database():
+    """Load the face database on the first request of a process that didn't warm up"""
+    if DB is None:
+        load_database()
 
 def decode_image(image_data):
     """Decode base64 image or file upload"""
     try:
-        # If it's base64 string
+        # If it's base64 string, skip any data URI prefix and decode the str directly:
+        # a2b_base64 reads ASCII str data in place, so the slice is the only copy
         if isinstance(image_data, str):
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
+            image_bytes = binascii.a2b_base64(image_data[image_data.find(',') + 1:])
         else:
-            # If it's a file upload
-            image = Image.open(image_data)
+            # If it's a file upload, read the raw bytes straight from the request stream
+            image_bytes = image_data.read()
+        
+        # Decode JPEGs straight into a contiguous RGB array with SIMD libjpeg-turbo
+        if image_bytes[:3] == JPEG_MAGIC:
+            image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError('corrupt JPEG data')
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        
+        image = Image.open(io.BytesIO(image_bytes))
         
         # Convert to RGB if necessary
         if image.mode != 'RGB':
@@ -48,6 +628,53 @@ def decode_image(image_data):
     except Exception as e:
         raise ValueError(f"Failed to decode image: {str(e)}")
 
+def get_request_data():
+    """Return (image, fields) from a multipart upload or a JSON body, parsing only the one that was sent"""
+    if request.files:
+        return request.files.get('image'), request.form
+    body = request.get_json(silent=True)
+    # Anything but a JSON object (e.g. an array) counts as no data
+    if not isinstance(body, dict):
+        body = {}
+    return body.get('image'), body
+
+def locate_faces(image_array):
+    """Find face locations, running detection on a downscaled copy of large images"""
+    height, width = image_array.shape[:2]
+    scale = DETECTION_MAX_SIZE / max(height, width)
+    if scale >= 1:
+        return face_recognition.face_locations(image_array, number_of_times_to_upsample=DETECTION_UPSAMPLE, model=DETECTION_MODEL)
+    
+    small = Image.fromarray(image_array).resize((int(width * scale), int(height * scale)), Image.BILINEAR)
+    face_locations = face_recognition.face_locations(np.asarray(small), number_of_times_to_upsample=DETECTION_UPSAMPLE, model=DETECTION_MODEL)
+    
+    # Scale (top, right, bottom, left) boxes back to the original image
+    return [tuple(int(v / scale) for v in location) for location in face_locations]
+
+def format_timestamp(timestamp):
+    """Format a stored registration time (epoch seconds, or an ISO string from older versions)"""
+    if timestamp is None:
+        return 'Unknown'
+    if isinstance(timestamp, str):
+        return timestamp
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+@lru_cache(maxsize=1)
+def format_second(second):
+    """Format an epoch second, cached so repeated calls within the same second reuse the string"""
+    return datetime.fromtimestamp(second).isoformat()
+
+def warm_up():
+    """Load the face database and run the detector, encoder and search kernel once so the first request doesn't pay for model/CUDA initialization or JIT compilation"""
+    load_database()
+    blank = np.zeros((DETECTION_MAX_SIZE, DETECTION_MAX_SIZE, 3), dtype=np.uint8)
+    locate_faces(blank)
+    # search() passes the read-only encodings memmap, which Numba compiles separately
+    embeddings = np.zeros((1, EMBEDDING_DIM), dtype=np.float32)
+    embeddings.setflags(write=False)
+    nearest(embeddings, np.zeros(1, dtype=bool), np.zeros((1, EMBEDDING_DIM), dtype=np.float32))
+    face_recognition.face_encodings(blank, [(0, DETECTION_MAX_SIZE, DETECTION_MAX_SIZE, 0)], model=LANDMARK_MODEL)
+
 @app.route('/', methods=['GET'])
 def index():
     """API documentation endpoint"""
@@ -87,7 +714,7 @@ def index():
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return jsonify({'status': 'healthy', 'timestamp': format_second(int(time.time()))})
 
 @app.route('/register', methods=['POST'])
 def register_face():
@@ -100,18 +727,14 @@ def register_face():
     - gender: person's gender
     """
     try:
-        # Get image
-        if 'image' in request.files:
-            image_data = request.files['image']
-        elif 'image' in request.json:
-            image_data = request.json['image']
-        else:
+        # Get image and metadata
+        image_data, form = get_request_data()
+        if image_data is None:
             return jsonify({'error': 'No image provided'}), 400
         
-        # Get metadata
-        name = request.form.get('name') or request.json.get('name')
-        age = request.form.get('age') or request.json.get('age')
-        gender = request.form.get('gender') or request.json.get('gender')
+        name = form.get('name')
+        age = form.get('age')
+        gender = form.get('gender')
         
         if not all([name, age, gender]):
             return jsonify({'error': 'Name, age, and gender are required'}), 400
@@ -120,8 +743,8 @@ def register_face():
         image_array = decode_image(image_data)
         
         # Find face encodings
-        face_locations = face_recognition.face_locations(image_array)
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        face_locations = locate_faces(image_array)
+        face_encodings = face_recognition.face_encodings(image_array, face_locations, model=LANDMARK_MODEL)
         
         if len(face_encodings) == 0:
             return jsonify({'error': 'No face detected in image'}), 400
@@ -129,29 +752,22 @@ def register_face():
         if len(face_encodings) > 1:
             return jsonify({'error': 'Multiple faces detected. Please provide image with single face'}), 400
         
-        # Load existing data
-        data = load_data()
-        
         # Add new face encoding and metadata
         face_encoding = face_encodings[0]
         metadata = {
             'name': str(name),
             'age': int(age),
             'gender': str(gender),
-            'registered_at': datetime.now().isoformat()
+            'registered_at': time.time()
         }
         
-        data['encodings'].append(face_encoding)
-        data['metadata'].append(metadata)
-        
-        # Save data
-        save_data(data)
+        person_id = DB.add(face_encoding, metadata)
         
         return jsonify({
             'success': True,
             'message': f'Successfully registered {name}',
-            'person_id': int(len(data['encodings']) - 1),
-            'metadata': metadata
+            'person_id': int(person_id),
+            'metadata': {**metadata, 'registered_at': format_timestamp(metadata['registered_at'])}
         }), 200
         
     except Exception as e:
@@ -166,54 +782,41 @@ def recognize_face():
     """
     try:
         # Get image
-        if 'image' in request.files:
-            image_data = request.files['image']
-        elif 'image' in request.json:
-            image_data = request.json['image']
-        else:
+        image_data, _ = get_request_data()
+        if image_data is None:
             return jsonify({'error': 'No image provided'}), 400
         
         # Decode image
         image_array = decode_image(image_data)
         
         # Find face encodings
-        face_locations = face_recognition.face_locations(image_array)
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        face_locations = locate_faces(image_array)
+        face_encodings = face_recognition.face_encodings(image_array, face_locations, model=LANDMARK_MODEL)
         
         if len(face_encodings) == 0:
             return jsonify({'error': 'No face detected in image'}), 400
         
-        # Load stored data
-        data = load_data()
-        
-        if len(data['encodings']) == 0:
+        DB.refresh()
+        if len(DB) == 0:
             return jsonify({'error': 'No registered faces in database'}), 404
         
+        # Match every detected face in one batched search
+        matches = DB.search(face_encodings)
+        
         # Check each detected face
         results = []
-        for face_encoding in face_encodings:
-            # Compare with stored encodings
-            matches = face_recognition.compare_faces(data['encodings'], face_encoding, tolerance=0.6)
-            face_distances = face_recognition.face_distance(data['encodings'], face_encoding)
-            
-            if True in matches:
-                # Get best match
-                best_match_index = np.argmin(face_distances)
+        for person_id, metadata, distance in matches:
+            if distance <= TOLERANCE:
+                confidence = 1 - distance
                 
-                if matches[best_match_index]:
-                    metadata = data['metadata'][best_match_index]
-                    confidence = 1 - face_distances[best_match_index]
-                    
-                    results.append({
-                        'recognized': True,
-                        'name': str(metadata['name']),
-                        'age': int(metadata['age']),
-                        'gender': str(metadata['gender']),
-                        'confidence': float(confidence),
-                        'person_id': int(best_match_index)
-                    })
-                else:
-                    results.append({'recognized': False, 'message': 'Face not recognized'})
+                results.append({
+                    'recognized': True,
+                    'name': str(metadata['name']),
+                    'age': int(metadata['age']),
+                    'gender': str(metadata['gender']),
+                    'confidence': confidence,
+                    'person_id': person_id
+                })
             else:
                 results.append({'recognized': False, 'message': 'Face not recognized'})
         
@@ -229,15 +832,15 @@ def recognize_face():
 def list_people():
     """List all registered people"""
     try:
-        data = load_data()
+        DB.refresh()
         people = []
-        for i, metadata in enumerate(data['metadata']):
+        for person_id, metadata in DB.people():
             people.append({
-                'person_id': int(i),
+                'person_id': int(person_id),
                 'name': str(metadata['name']),
                 'age': int(metadata['age']),
                 'gender': str(metadata['gender']),
-                'registered_at': str(metadata.get('registered_at', 'Unknown'))
+                'registered_at': format_timestamp(metadata.get('registered_at'))
             })
         return jsonify({'count': int(len(people)), 'people': people}), 200
     except Exception as e:
@@ -247,24 +850,16 @@ def list_people():
 def delete_person(person_id):
     """Delete a registered person by ID"""
     try:
-        data = load_data()
+        # Tombstone the entry so other person IDs don't shift
+        deleted_metadata = DB.remove(person_id)
         
-        if person_id < 0 or person_id >= len(data['encodings']):
+        if deleted_metadata is None:
             return jsonify({'error': 'Invalid person_id'}), 404
         
-        deleted_metadata = data['metadata'][person_id]
-        
-        # Remove from lists
-        del data['encodings'][person_id]
-        del data['metadata'][person_id]
-        
-        # Save updated data
-        save_data(data)
-        
         return jsonify({
             'success': True,
             'message': f'Deleted {deleted_metadata["name"]}',
-            'deleted': deleted_metadata
+            'deleted': {**deleted_metadata, 'registered_at': format_timestamp(deleted_metadata.get('registered_at'))}
         }), 200
         
     except Exception as e:
@@ -274,8 +869,7 @@ def delete_person(person_id):
 def clear_database():
     """Clear all registered faces (use with caution)"""
     try:
-        data = {'encodings': [], 'metadata': []}
-        save_data(data)
+        DB.clear()
         return jsonify({'success': True, 'message': 'Database cleared'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -289,4 +883,6 @@ if __name__ == '__main__':
     print("  DELETE /delete/<person_id> - Delete a person")
     print("  POST /clear - Clear all data")
     print("  GET /health - Health check")
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    warm_up()
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
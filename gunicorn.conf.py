@@ -0,0 +1,31 @@
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+# The workers already use every core, so give each one single-threaded Numba
+# and FAISS (OpenMP) pools instead of cpu_count() threads apiece. Set before the
+# app (and with it numba and faiss) is imported, since both read these at load
+os.environ.setdefault('NUMBA_NUM_THREADS', '1')
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
+import dlib
+
+bind = '0.0.0.0:5000'
+
+# One worker process per core for CPU-bound detection/encoding; two threads each
+# to overlap request I/O
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = 2
+
+# Import app.py once in the master so the dlib models are shared with the
+# workers copy-on-write (the face database is loaded by each worker). Not with
+# CUDA: importing face_recognition builds its models on the GPU, and a CUDA
+# context doesn't survive fork, so each worker imports the app itself
+preload_app = not dlib.DLIB_USE_CUDA
+
+def post_fork(server, worker):
+    # CUDA contexts and JIT/native thread pools (Numba, FAISS's OpenMP) don't
+    # survive fork, so each worker loads the face database and initializes its own
+    from app import warm_up
+    warm_up()